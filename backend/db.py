@@ -2,8 +2,14 @@
 
 import sqlite3
 import hashlib
+import hmac
 import os
-from typing import Optional, Dict, Any, List
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
 
 """
 SQLite helper functions for PingPong Web Chat.
@@ -18,94 +24,490 @@ The rest of the code only calls these functions instead of writing raw SQL.
 
 DB_PATH = "chat.db"
 
+# Number of pre-opened connections shared by the whole process. Each one
+# keeps its own warm page cache, so reusing them is much cheaper than
+# opening a fresh connection per request.
+POOL_SIZE = 5
 
-def get_connection() -> sqlite3.Connection:
+_pool: Optional["queue.Queue[sqlite3.Connection]"] = None
+_pool_lock = threading.Lock()
+
+
+# Timestamps are stored as INTEGER milliseconds since the Unix epoch:
+# smaller than ISO text, and ORDER BY / index comparisons become integer
+# compares. This SQL expression is the ms-precision "now" (the 'subsec'
+# modifier needs SQLite >= 3.42, so it is spelled out via julianday).
+MS_NOW_SQL = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+
+def _iso_from_ms(ms: int) -> str:
     """
-    Open a new SQLite connection.
-    Using a new connection per request keeps things simple and thread-safe
-    for a small project.
+    Format a stored millisecond timestamp as an ISO-8601 UTC string for
+    the API.
     """
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat()
 
 
-def init_db() -> None:
+# ---------- SQL statements ----------
+
+# Every per-call statement lives here as a module-level constant so
+# repeated executions pass the same string and hit the connection's
+# compiled-statement cache. Only the one-time DDL in init_db stays
+# inline.
+
+SQL_SELECT_USER_BY_USERNAME = (
+    "SELECT id, username, password_hash FROM users WHERE username = ?"
+)
+
+SQL_SELECT_USER_BY_TOKEN = """
+    SELECT u.id, u.username
+    FROM sessions s
+    JOIN users u ON s.user_id = u.id
+    WHERE s.token = ?
+"""
+
+# Written as UNION ALL rather than OR so each branch matches the
+# partial accepted-pair index, and pinned with INDEXED BY because the
+# planner otherwise prefers the UNIQUE pair autoindex, which has to
+# fetch the row to check status. The partial index never touches rows.
+SQL_ARE_FRIENDS = """
+    SELECT 1 FROM friend_requests INDEXED BY idx_fr_accepted_pair
+    WHERE status = 'accepted' AND from_user_id = ? AND to_user_id = ?
+    UNION ALL
+    SELECT 1 FROM friend_requests INDEXED BY idx_fr_accepted_pair
+    WHERE status = 'accepted' AND from_user_id = ? AND to_user_id = ?
+    LIMIT 1
+"""
+
+SQL_INSERT_MESSAGE = """
+    INSERT INTO messages (from_user_id, to_user_id, kind, text, url)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_MESSAGE_RETURNING = SQL_INSERT_MESSAGE + "    RETURNING id, created_at\n"
+
+SQL_INSERT_USER_RETURNING = (
+    "INSERT INTO users (username, password_hash) VALUES (?, ?) RETURNING id"
+)
+
+SQL_UPDATE_PASSWORD_HASH = "UPDATE users SET password_hash = ? WHERE id = ?"
+
+SQL_INSERT_SESSION = "INSERT INTO sessions (token, user_id) VALUES (?, ?)"
+
+SQL_DELETE_SESSION = "DELETE FROM sessions WHERE token = ?"
+
+SQL_SELECT_RELATIONSHIP = """
+    SELECT id, status
+    FROM friend_requests
+    WHERE (from_user_id = ? AND to_user_id = ?)
+       OR (from_user_id = ? AND to_user_id = ?)
+"""
+
+SQL_INSERT_FRIEND_REQUEST_RETURNING = """
+    INSERT INTO friend_requests (from_user_id, to_user_id, status)
+    VALUES (?, ?, 'pending')
+    RETURNING id
+"""
+
+SQL_SELECT_FRIEND_REQUEST = """
+    SELECT fr.id, fr.from_user_id, fr.to_user_id, fr.status,
+           u_from.username AS from_username,
+           u_to.username   AS to_username
+    FROM friend_requests fr
+    JOIN users u_from ON fr.from_user_id = u_from.id
+    JOIN users u_to   ON fr.to_user_id   = u_to.id
+    WHERE fr.id = ?
+"""
+
+SQL_UPDATE_FRIEND_REQUEST_STATUS = f"""
+    UPDATE friend_requests
+    SET status = ?, responded_at = {MS_NOW_SQL}
+    WHERE id = ?
+"""
+
+SQL_FRIEND_SUMMARY = """
+    SELECT 'friend' AS kind, u.id AS user_id, u.username, NULL AS request_id, NULL AS status
+    FROM friend_requests fr
+    JOIN users u ON
+        (CASE
+           WHEN fr.from_user_id = ? THEN fr.to_user_id
+           ELSE fr.from_user_id
+         END) = u.id
+    WHERE (fr.from_user_id = ? OR fr.to_user_id = ?)
+      AND fr.status = 'accepted'
+
+    UNION ALL
+
+    SELECT 'incoming', NULL, u_from.username, fr.id, NULL
+    FROM friend_requests fr
+    JOIN users u_from ON fr.from_user_id = u_from.id
+    WHERE fr.to_user_id = ? AND fr.status = 'pending'
+
+    UNION ALL
+
+    SELECT 'outgoing', NULL, u_to.username, fr.id, fr.status
+    FROM friend_requests fr
+    JOIN users u_to ON fr.to_user_id = u_to.id
+    WHERE fr.from_user_id = ? AND fr.status = 'pending'
+"""
+
+
+def _build_conversation_sql(cursor_filter: str) -> str:
+    half = f"""
+        SELECT m.id,
+               u_from.username AS from_username,
+               u_to.username   AS to_username,
+               m.kind,
+               m.text,
+               m.url,
+               m.created_at
+        FROM messages m
+        JOIN users u_from ON m.from_user_id = u_from.id
+        JOIN users u_to   ON m.to_user_id   = u_to.id
+        WHERE m.from_user_id = ? AND m.to_user_id = ? {cursor_filter}
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT ?
     """
-    Create tables if they do not exist yet.
+    return f"""
+        SELECT * FROM ({half})
+        UNION ALL
+        SELECT * FROM ({half})
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
     """
-    conn = get_connection()
-    cur = conn.cursor()
 
-    # Basic users table
-    cur.execute(
+
+# Both variants of the conversation query are built once at import time
+# instead of per call.
+SQL_CONVERSATION = _build_conversation_sql("")
+SQL_CONVERSATION_BEFORE = _build_conversation_sql("AND m.id < ?")
+
+
+def _open_connection() -> sqlite3.Connection:
+    """
+    Open a new SQLite connection.
+
+    Every connection is put into WAL mode with tuned PRAGMAs so that
+    concurrent readers and writers (HTTP requests + WebSockets) do not
+    block each other and each commit costs a single fsync at most.
+    """
+    # cached_statements keeps compiled statements around per connection;
+    # raised from the default 128 so every query in this module stays
+    # compiled across calls on a pooled connection.
+    conn = sqlite3.connect(
+        DB_PATH, isolation_level=None, check_same_thread=False, cached_statements=256
+    )
+    conn.row_factory = sqlite3.Row
+    # journal_mode=WAL is persistent in the database file; the rest must be
+    # re-applied on every new connection.
+    conn.executescript(
         """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL
-        );
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+        PRAGMA mmap_size=2147483648;
+        PRAGMA busy_timeout=5000;
+        PRAGMA foreign_keys=ON;
         """
     )
+    return conn
 
-    # Sessions map random token -> user
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS sessions (
+
+def _get_pool() -> "queue.Queue[sqlite3.Connection]":
+    """
+    Return the shared connection pool, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=POOL_SIZE)
+                for _ in range(POOL_SIZE):
+                    pool.put(_open_connection())
+                _pool = pool
+    return _pool
+
+
+@contextmanager
+def connection() -> Iterator[sqlite3.Connection]:
+    """
+    Borrow a connection from the pool for the duration of a `with` block.
+
+    Blocks if all connections are in use, and always returns the
+    connection to the pool afterwards, even on error.
+    """
+    pool = _get_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+def optimize() -> None:
+    """
+    Run PRAGMA optimize so SQLite can refresh its query-planner statistics.
+    Intended to be called once at shutdown.
+    """
+    with connection() as conn:
+        conn.execute("PRAGMA optimize")
+
+
+# TEXT -> INTEGER ms conversion for legacy CURRENT_TIMESTAMP values
+# (which are UTC "YYYY-MM-DD HH:MM:SS" strings)
+_MS_FROM_TEXT = "CAST(strftime('%s', {col}) AS INTEGER) * 1000"
+
+_TIMESTAMP_MIGRATIONS = {
+    "sessions": f"""
+        CREATE TABLE sessions_new (
             token TEXT PRIMARY KEY,
             user_id INTEGER NOT NULL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            created_at INTEGER NOT NULL DEFAULT ({MS_NOW_SQL}),
             FOREIGN KEY (user_id) REFERENCES users(id)
         );
-        """
-    )
-
-    # Friend requests / friendships
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS friend_requests (
+        INSERT INTO sessions_new
+            SELECT token, user_id, {_MS_FROM_TEXT.format(col='created_at')}
+            FROM sessions;
+        DROP TABLE sessions;
+        ALTER TABLE sessions_new RENAME TO sessions;
+    """,
+    "friend_requests": f"""
+        CREATE TABLE friend_requests_new (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             from_user_id INTEGER NOT NULL,
             to_user_id INTEGER NOT NULL,
             status TEXT NOT NULL CHECK (status IN ('pending', 'accepted', 'rejected')),
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            responded_at TEXT,
+            created_at INTEGER NOT NULL DEFAULT ({MS_NOW_SQL}),
+            responded_at INTEGER,
             UNIQUE (from_user_id, to_user_id),
             FOREIGN KEY (from_user_id) REFERENCES users(id),
             FOREIGN KEY (to_user_id) REFERENCES users(id)
         );
-        """
-    )
-
-    # Messages between users
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS messages (
+        INSERT INTO friend_requests_new
+            SELECT id, from_user_id, to_user_id, status,
+                   {_MS_FROM_TEXT.format(col='created_at')},
+                   {_MS_FROM_TEXT.format(col='responded_at')}
+            FROM friend_requests;
+        DROP TABLE friend_requests;
+        ALTER TABLE friend_requests_new RENAME TO friend_requests;
+    """,
+    "messages": f"""
+        CREATE TABLE messages_new (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             from_user_id INTEGER NOT NULL,
             to_user_id INTEGER NOT NULL,
             kind TEXT NOT NULL CHECK (kind IN ('text', 'file')),
             text TEXT NOT NULL,
             url TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            created_at INTEGER NOT NULL DEFAULT ({MS_NOW_SQL}),
             FOREIGN KEY (from_user_id) REFERENCES users(id),
             FOREIGN KEY (to_user_id) REFERENCES users(id)
         );
-        """
-    )
+        INSERT INTO messages_new
+            SELECT id, from_user_id, to_user_id, kind, text, url,
+                   {_MS_FROM_TEXT.format(col='created_at')}
+            FROM messages;
+        DROP TABLE messages;
+        ALTER TABLE messages_new RENAME TO messages;
+    """,
+}
+
+
+def _migrate_text_timestamps(cur: sqlite3.Cursor) -> None:
+    """
+    Rebuild any table whose created_at column is still legacy TEXT so it
+    stores INTEGER milliseconds instead. No-op on up-to-date databases.
+    """
+    for table, script in _TIMESTAMP_MIGRATIONS.items():
+        cur.execute(f"PRAGMA table_info({table})")
+        col_type = next(
+            (row["type"].upper() for row in cur.fetchall() if row["name"] == "created_at"),
+            None,
+        )
+        if col_type != "TEXT":
+            continue
+
+        # Statements run one by one (executescript would commit the
+        # surrounding transaction) so a failed rebuild rolls back whole
+        cur.execute("PRAGMA foreign_keys=OFF")
+        cur.execute("BEGIN")
+        try:
+            for statement in script.split(";"):
+                if statement.strip():
+                    cur.execute(statement)
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        finally:
+            cur.execute("PRAGMA foreign_keys=ON")
+
+
+def init_db() -> None:
+    """
+    Create tables if they do not exist yet.
+    """
+    with connection() as conn:
+        cur = conn.cursor()
+
+        # Basic users table
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL
+            );
+            """
+        )
+
+        # Sessions map random token -> user
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                created_at INTEGER NOT NULL DEFAULT ({MS_NOW_SQL}),
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+            """
+        )
+
+        # Friend requests / friendships
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS friend_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_user_id INTEGER NOT NULL,
+                to_user_id INTEGER NOT NULL,
+                status TEXT NOT NULL CHECK (status IN ('pending', 'accepted', 'rejected')),
+                created_at INTEGER NOT NULL DEFAULT ({MS_NOW_SQL}),
+                responded_at INTEGER,
+                UNIQUE (from_user_id, to_user_id),
+                FOREIGN KEY (from_user_id) REFERENCES users(id),
+                FOREIGN KEY (to_user_id) REFERENCES users(id)
+            );
+            """
+        )
+
+        # Messages between users
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_user_id INTEGER NOT NULL,
+                to_user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL CHECK (kind IN ('text', 'file')),
+                text TEXT NOT NULL,
+                url TEXT,
+                created_at INTEGER NOT NULL DEFAULT ({MS_NOW_SQL}),
+                FOREIGN KEY (from_user_id) REFERENCES users(id),
+                FOREIGN KEY (to_user_id) REFERENCES users(id)
+            );
+            """
+        )
 
-    conn.commit()
-    conn.close()
+        # Databases created before the INTEGER timestamps need their
+        # tables rebuilt (runs before index creation, since a rebuild
+        # drops the table's indexes)
+        _migrate_text_timestamps(cur)
+
+        # Indexes for the hot queries. get_conversation filters on both
+        # directions of a user pair and orders by (created_at, id), so each
+        # direction gets a composite index; the friend lookups filter on
+        # one side plus status.
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_msg_pair_created
+            ON messages(from_user_id, to_user_id, created_at, id);
+            """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_msg_pair_rev
+            ON messages(to_user_id, from_user_id, created_at, id);
+            """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_fr_to_status
+            ON friend_requests(to_user_id, status);
+            """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_fr_from_status
+            ON friend_requests(from_user_id, status);
+            """
+        )
+
+        # Partial index restricted to accepted rows makes are_friends a
+        # pure index probe (covering, no row fetch to check status).
+        # One index serves both directions since each branch of the
+        # query probes with both user ids.
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_fr_accepted_pair
+            ON friend_requests(from_user_id, to_user_id)
+            WHERE status = 'accepted';
+            """
+        )
+
+        # Refresh planner statistics so the new indexes get picked
+        cur.execute("ANALYZE;")
 
 
 # ---------- Password helpers ----------
 
+# scrypt cost parameters: ~16 MB of memory and a few tens of ms per
+# hash, which is the point — offline guessing gets expensive while a
+# single login stays imperceptible.
+_SCRYPT_N = 2 ** 14
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+
+
+def _scrypt(password: str, salt: bytes) -> bytes:
+    return hashlib.scrypt(
+        password.encode("utf-8"), salt=salt, n=_SCRYPT_N, r=_SCRYPT_R, p=_SCRYPT_P
+    )
+
 
 def hash_password(password: str) -> str:
     """
-    Very simple password hashing using SHA-256.
+    Hash a password with scrypt (memory-hard KDF) and a random salt.
+
+    Stored as "scrypt$<salt hex>$<digest hex>".
+    """
+    salt = os.urandom(16)
+    return f"scrypt${salt.hex()}${_scrypt(password, salt).hex()}"
+
+
+def verify_password(stored: str, password: str) -> bool:
+    """
+    Check a password against a stored hash in constant time.
+
+    Understands current scrypt hashes and the legacy unsalted SHA-256
+    hex format from older databases.
+    """
+    if stored.startswith("scrypt$"):
+        _, salt_hex, digest_hex = stored.split("$")
+        digest = _scrypt(password, bytes.fromhex(salt_hex))
+        return hmac.compare_digest(digest.hex(), digest_hex)
+
+    # Legacy unsalted SHA-256
+    legacy = hashlib.sha256(password.encode("utf-8")).hexdigest()
+    return hmac.compare_digest(legacy, stored)
+
+
+def update_password_hash(user_id: int, password: str) -> None:
+    """
+    Re-hash a password with the current scheme. Used to upgrade legacy
+    SHA-256 rows on successful login.
     """
-    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+    with connection() as conn:
+        conn.execute(SQL_UPDATE_PASSWORD_HASH, (hash_password(password), user_id))
 
 
 # ---------- Users ----------
@@ -117,33 +519,60 @@ def create_user(username: str, password: str) -> Dict[str, Any]:
 
     Raises ValueError if the username already exists.
     """
-    conn = get_connection()
-    cur = conn.cursor()
+    with connection() as conn:
+        cur = conn.cursor()
+
+        try:
+            cur.execute(
+                SQL_INSERT_USER_RETURNING,
+                (username, hash_password(password)),
+            )
+        except sqlite3.IntegrityError:
+            raise ValueError("Username already taken")
+
+        user_id = cur.fetchone()["id"]
+
+    _cache_username(user_id, username)
+    return {"id": user_id, "username": username}
 
-    try:
-        cur.execute(
-            "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-            (username, hash_password(password)),
-        )
-        conn.commit()
-        user_id = cur.lastrowid
-    except sqlite3.IntegrityError:
-        conn.close()
-        raise ValueError("Username already taken")
-
-    cur.execute("SELECT id, username FROM users WHERE id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return dict(row)
+
+# Usernames are immutable in this schema, so id <-> username pairs can
+# be cached for the lifetime of the process once seen.
+_username_to_id: Dict[str, int] = {}
+_id_to_username: Dict[int, str] = {}
+_username_cache_lock = threading.Lock()
+
+
+def _cache_username(user_id: int, username: str) -> None:
+    with _username_cache_lock:
+        _username_to_id[username] = user_id
+        _id_to_username[user_id] = username
 
 
 def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, password_hash FROM users WHERE username = ?", (username,))
-    row = cur.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_SELECT_USER_BY_USERNAME, (username,))
+        row = cur.fetchone()
+
+    if not row:
+        return None
+    _cache_username(row["id"], row["username"])
+    return dict(row)
+
+
+def resolve_username(username: str) -> Optional[int]:
+    """
+    Translate a username to its user id, or None if unknown.
+    Answered from the in-process map after the first lookup.
+    """
+    with _username_cache_lock:
+        user_id = _username_to_id.get(username)
+    if user_id is not None:
+        return user_id
+
+    user = get_user_by_username(username)
+    return user["id"] if user else None
 
 
 # ---------- Sessions ----------
@@ -156,46 +585,69 @@ def create_session(user_id: int) -> str:
     """
     token = os.urandom(24).hex()
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO sessions (token, user_id) VALUES (?, ?)",
-        (token, user_id),
-    )
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_INSERT_SESSION, (token, user_id))
 
     return token
 
 
+# Sessions never change once issued, so token -> user rows can be cached
+# in-process until logout. Capped so stale tokens cannot grow memory
+# forever; on overflow an arbitrary entry is evicted.
+TOKEN_CACHE_MAX = 4096
+
+_token_cache: Dict[str, Dict[str, Any]] = {}
+_token_cache_lock = threading.Lock()
+
+
 def get_user_by_token(token: str) -> Optional[Dict[str, Any]]:
     """
     Look up the user associated with this session token.
     Returns a dict with user info or None if invalid.
+
+    Hits the in-process cache first; every request carries a token, so
+    this skips a sessions/users join on all but the first lookup.
     """
-    conn = get_connection()
-    cur = conn.cursor()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+    if cached:
+        return dict(cached)
 
-    cur.execute(
-        """
-        SELECT u.id, u.username
-        FROM sessions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.token = ?
-        """,
-        (token,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with connection() as conn:
+        cur = conn.cursor()
+
+        cur.execute(SQL_SELECT_USER_BY_TOKEN, (token,))
+        row = cur.fetchone()
+
+    if not row:
+        return None
+
+    user = dict(row)
+    with _token_cache_lock:
+        if len(_token_cache) >= TOKEN_CACHE_MAX:
+            _token_cache.pop(next(iter(_token_cache)))
+        _token_cache[token] = user
+    return dict(user)
+
+
+def delete_session(token: str) -> None:
+    """
+    Remove a session (logout) and drop it from the token cache.
+    """
+    with connection() as conn:
+        conn.execute(SQL_DELETE_SESSION, (token,))
+    with _token_cache_lock:
+        _token_cache.pop(token, None)
 
 
 # ---------- Friends / Friend Requests ----------
 
 
-def create_friend_request(from_user_id: int, to_username: str) -> Dict[str, Any]:
+def create_friend_request(from_user_id: int, from_username: str, to_username: str) -> Dict[str, Any]:
     """
     Create a friend request from one user to another (by username).
+    The caller passes its own username so no join is needed afterwards.
 
     Raises ValueError on:
     - user not found
@@ -211,55 +663,33 @@ def create_friend_request(from_user_id: int, to_username: str) -> Dict[str, Any]
     if to_user_id == from_user_id:
         raise ValueError("Cannot add yourself as a friend")
 
-    conn = get_connection()
-    cur = conn.cursor()
+    with connection() as conn:
+        cur = conn.cursor()
 
-    # Check for any existing relationship in either direction
-    cur.execute(
-        """
-        SELECT id, status
-        FROM friend_requests
-        WHERE (from_user_id = ? AND to_user_id = ?)
-           OR (from_user_id = ? AND to_user_id = ?)
-        """,
-        (from_user_id, to_user_id, to_user_id, from_user_id),
-    )
-    row = cur.fetchone()
-    if row:
-        status = row["status"]
-        conn.close()
-        if status == "accepted":
-            raise ValueError("You are already friends")
-        elif status == "pending":
-            raise ValueError("A pending friend request already exists")
-        else:
-            raise ValueError("A friend request already exists")
-
-    # Create new pending request
-    cur.execute(
-        """
-        INSERT INTO friend_requests (from_user_id, to_user_id, status)
-        VALUES (?, ?, 'pending')
-        """,
-        (from_user_id, to_user_id),
-    )
-    conn.commit()
-
-    request_id = cur.lastrowid
-    cur.execute(
-        """
-        SELECT fr.id, fr.status, u_from.username AS from_username,
-               u_to.username AS to_username
-        FROM friend_requests fr
-        JOIN users u_from ON fr.from_user_id = u_from.id
-        JOIN users u_to   ON fr.to_user_id   = u_to.id
-        WHERE fr.id = ?
-        """,
-        (request_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return dict(row)
+        # Check for any existing relationship in either direction
+        cur.execute(
+            SQL_SELECT_RELATIONSHIP,
+            (from_user_id, to_user_id, to_user_id, from_user_id),
+        )
+        row = cur.fetchone()
+        if row:
+            status = row["status"]
+            if status == "accepted":
+                raise ValueError("You are already friends")
+            elif status == "pending":
+                raise ValueError("A pending friend request already exists")
+            else:
+                raise ValueError("A friend request already exists")
+
+        # Create new pending request
+        cur.execute(SQL_INSERT_FRIEND_REQUEST_RETURNING, (from_user_id, to_user_id))
+
+        return {
+            "id": cur.fetchone()["id"],
+            "status": "pending",
+            "from_username": from_username,
+            "to_username": target["username"],
+        }
 
 
 def respond_to_friend_request(request_id: int, to_user_id: int, accept: bool) -> Dict[str, Any]:
@@ -269,108 +699,68 @@ def respond_to_friend_request(request_id: int, to_user_id: int, accept: bool) ->
     Only the 'to_user' is allowed to respond.
     Raises ValueError if request not found, not pending, or user mismatch.
     """
-    conn = get_connection()
-    cur = conn.cursor()
+    with connection() as conn:
+        cur = conn.cursor()
 
-    cur.execute(
-        """
-        SELECT id, from_user_id, to_user_id, status
-        FROM friend_requests
-        WHERE id = ?
-        """,
-        (request_id,),
-    )
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        raise ValueError("Friend request not found")
+        # Fetch the request and both usernames in the validation query so
+        # no second SELECT is needed after the UPDATE.
+        cur.execute(SQL_SELECT_FRIEND_REQUEST, (request_id,))
+        row = cur.fetchone()
+        if not row:
+            raise ValueError("Friend request not found")
 
-    if row["to_user_id"] != to_user_id:
-        conn.close()
-        raise ValueError("You are not allowed to respond to this request")
+        if row["to_user_id"] != to_user_id:
+            raise ValueError("You are not allowed to respond to this request")
 
-    if row["status"] != "pending":
-        conn.close()
-        raise ValueError("Friend request is not pending")
+        if row["status"] != "pending":
+            raise ValueError("Friend request is not pending")
 
-    new_status = "accepted" if accept else "rejected"
-    cur.execute(
-        """
-        UPDATE friend_requests
-        SET status = ?, responded_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-        """,
-        (new_status, request_id),
-    )
-    conn.commit()
+        new_status = "accepted" if accept else "rejected"
+        cur.execute(SQL_UPDATE_FRIEND_REQUEST_STATUS, (new_status, request_id))
 
-    # Return basic info
-    cur.execute(
-        """
-        SELECT fr.id, fr.status,
-               u_from.username AS from_username,
-               u_to.username   AS to_username
-        FROM friend_requests fr
-        JOIN users u_from ON fr.from_user_id = u_from.id
-        JOIN users u_to   ON fr.to_user_id   = u_to.id
-        WHERE fr.id = ?
-        """,
-        (request_id,),
-    )
-    out = cur.fetchone()
-    conn.close()
-    return dict(out)
+    # The pair's friendship just changed (or was decided), so any cached
+    # answer is stale.
+    _invalidate_friend_cache(row["from_user_id"], to_user_id)
+
+    return {
+        "id": request_id,
+        "status": new_status,
+        "from_username": row["from_username"],
+        "to_username": row["to_username"],
+    }
 
 
 def get_friend_summary(user_id: int) -> Dict[str, List[Dict[str, Any]]]:
     """
     Return a summary of friendships and friend requests for this user.
-    """
-    conn = get_connection()
-    cur = conn.cursor()
-
-    # Friends are accepted requests in either direction
-    cur.execute(
-        """
-        SELECT u.id, u.username
-        FROM friend_requests fr
-        JOIN users u ON
-            (CASE
-               WHEN fr.from_user_id = ? THEN fr.to_user_id
-               ELSE fr.from_user_id
-             END) = u.id
-        WHERE (fr.from_user_id = ? OR fr.to_user_id = ?)
-          AND fr.status = 'accepted'
-        """,
-        (user_id, user_id, user_id),
-    )
-    friends = [dict(row) for row in cur.fetchall()]
-
-    # Incoming pending requests (others → me)
-    cur.execute(
-        """
-        SELECT fr.id AS request_id, u_from.username AS from_username
-        FROM friend_requests fr
-        JOIN users u_from ON fr.from_user_id = u_from.id
-        WHERE fr.to_user_id = ? AND fr.status = 'pending'
-        """,
-        (user_id,),
-    )
-    incoming = [dict(row) for row in cur.fetchall()]
 
-    # Outgoing pending requests (me → others)
-    cur.execute(
-        """
-        SELECT fr.id AS request_id, u_to.username AS to_username, fr.status
-        FROM friend_requests fr
-        JOIN users u_to ON fr.to_user_id = u_to.id
-        WHERE fr.from_user_id = ? AND fr.status = 'pending'
-        """,
-        (user_id,),
-    )
-    outgoing = [dict(row) for row in cur.fetchall()]
+    Friends (accepted, either direction), incoming pending, and outgoing
+    pending requests come back from one UNION ALL statement with a
+    discriminator column, so the whole summary is a single round-trip
+    and one read snapshot.
+    """
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_FRIEND_SUMMARY, (user_id, user_id, user_id, user_id, user_id))
+        rows = cur.fetchall()
+
+    friends: List[Dict[str, Any]] = []
+    incoming: List[Dict[str, Any]] = []
+    outgoing: List[Dict[str, Any]] = []
+    for row in rows:
+        if row["kind"] == "friend":
+            friends.append({"id": row["user_id"], "username": row["username"]})
+        elif row["kind"] == "incoming":
+            incoming.append({"request_id": row["request_id"], "from_username": row["username"]})
+        else:
+            outgoing.append(
+                {
+                    "request_id": row["request_id"],
+                    "to_username": row["username"],
+                    "status": row["status"],
+                }
+            )
 
-    conn.close()
     return {
         "friends": friends,
         "incoming_requests": incoming,
@@ -378,96 +768,143 @@ def get_friend_summary(user_id: int) -> Dict[str, List[Dict[str, Any]]]:
     }
 
 
+# Friendship rarely changes but is checked on every message and upload,
+# so results are memoized per unordered user pair for a few minutes.
+# Mutations invalidate the pair immediately; the TTL only bounds how
+# long an entry can sit unused.
+FRIEND_CACHE_TTL = 300.0
+FRIEND_CACHE_MAX = 8192
+
+_friend_cache: Dict[tuple, tuple] = {}  # (low_id, high_id) -> (result, expires)
+_friend_cache_lock = threading.Lock()
+
+
+def _invalidate_friend_cache(user_id1: int, user_id2: int) -> None:
+    key = (min(user_id1, user_id2), max(user_id1, user_id2))
+    with _friend_cache_lock:
+        _friend_cache.pop(key, None)
+
+
 def are_friends(user_id1: int, user_id2: int) -> bool:
     """
     Return True if two users are friends (accepted request in either direction).
     """
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT 1
-        FROM friend_requests
-        WHERE status = 'accepted'
-          AND (
-                (from_user_id = ? AND to_user_id = ?)
-             OR (from_user_id = ? AND to_user_id = ?)
-          )
-        LIMIT 1
-        """,
-        (user_id1, user_id2, user_id2, user_id1),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return row is not None
+    key = (min(user_id1, user_id2), max(user_id1, user_id2))
+    now = time.monotonic()
+    with _friend_cache_lock:
+        cached = _friend_cache.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_ARE_FRIENDS, (user_id1, user_id2, user_id2, user_id1))
+        row = cur.fetchone()
+
+    result = row is not None
+    with _friend_cache_lock:
+        if len(_friend_cache) >= FRIEND_CACHE_MAX:
+            _friend_cache.pop(next(iter(_friend_cache)))
+        _friend_cache[key] = (result, now + FRIEND_CACHE_TTL)
+    return result
 
 
 # ---------- Messages ----------
 
 
-def save_message(from_user_id: int, to_user_id: int, kind: str, text: str, url: Optional[str]) -> Dict[str, Any]:
+def save_message(
+    from_user_id: int,
+    to_user_id: int,
+    kind: str,
+    text: str,
+    url: Optional[str],
+    from_username: str,
+    to_username: str,
+) -> Dict[str, Any]:
     """
-    Insert a message into the DB and return its basic info joined with usernames.
+    Insert a message into the DB and return its basic info.
+
+    The caller already knows both usernames, so the result is built from
+    the arguments plus the id and timestamp RETURNING hands back in the
+    same statement as the INSERT.
     """
-    conn = get_connection()
-    cur = conn.cursor()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            SQL_INSERT_MESSAGE_RETURNING,
+            (from_user_id, to_user_id, kind, text, url),
+        )
+        row = cur.fetchone()
+        msg_id, created_at = row["id"], row["created_at"]
 
-    cur.execute(
-        """
-        INSERT INTO messages (from_user_id, to_user_id, kind, text, url)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (from_user_id, to_user_id, kind, text, url),
-    )
-    conn.commit()
-    msg_id = cur.lastrowid
+    return {
+        "id": msg_id,
+        "from_username": from_username,
+        "to_username": to_username,
+        "kind": kind,
+        "text": text,
+        "url": url,
+        "created_at": _iso_from_ms(created_at),
+    }
 
-    cur.execute(
-        """
-        SELECT m.id,
-               u_from.username AS from_username,
-               u_to.username   AS to_username,
-               m.kind,
-               m.text,
-               m.url,
-               m.created_at
-        FROM messages m
-        JOIN users u_from ON m.from_user_id = u_from.id
-        JOIN users u_to   ON m.to_user_id   = u_to.id
-        WHERE m.id = ?
-        """,
-        (msg_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return dict(row)
 
+def save_messages_bulk(rows: List[tuple]) -> None:
+    """
+    Insert many messages in a single transaction.
 
-def get_conversation(user1_id: int, user2_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+    Each row is (from_user_id, to_user_id, kind, text, url). Batching a
+    burst of messages into one commit costs one fsync instead of one per
+    message.
     """
-    Return the most recent messages in the conversation between two users.
+    if not rows:
+        return
+
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.executemany(SQL_INSERT_MESSAGE, rows)
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+
+def get_conversation(
+    user1_id: int,
+    user2_id: int,
+    limit: int = 100,
+    before_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
     """
-    conn = get_connection()
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        SELECT u_from.username AS from_username,
-               u_to.username   AS to_username,
-               m.kind,
-               m.text,
-               m.url,
-               m.created_at
-        FROM messages m
-        JOIN users u_from ON m.from_user_id = u_from.id
-        JOIN users u_to   ON m.to_user_id   = u_to.id
-        WHERE (m.from_user_id = ? AND m.to_user_id = ?)
-           OR (m.from_user_id = ? AND m.to_user_id = ?)
-        ORDER BY m.created_at ASC, m.id ASC
-        LIMIT ?
-        """,
-        (user1_id, user2_id, user2_id, user1_id, limit),
-    )
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    Return the most recent messages in the conversation between two users,
+    oldest first.
+
+    The two directions of the pair are queried separately and merged with
+    UNION ALL so each half can walk its composite index backwards instead
+    of forcing a temp B-tree sort over the whole history. `before_id`
+    (exclusive) allows keyset pagination: pass the smallest message id
+    already shown to fetch the previous page.
+    """
+    # Each branch newest-first with its own LIMIT; the outer query merges
+    # and trims, and Python restores ascending order.
+    sql = SQL_CONVERSATION if before_id is None else SQL_CONVERSATION_BEFORE
+
+    half_params1: tuple = (user1_id, user2_id)
+    half_params2: tuple = (user2_id, user1_id)
+    if before_id is not None:
+        half_params1 += (before_id,)
+        half_params2 += (before_id,)
+    params = half_params1 + (limit,) + half_params2 + (limit, limit)
+
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+
+    out = []
+    for r in reversed(rows):
+        msg = dict(r)
+        msg["created_at"] = _iso_from_ms(msg["created_at"])
+        out.append(msg)
+    return out
@@ -1,13 +1,19 @@
 # backend/main.py
 
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import Dict, List
 from pathlib import Path
+import asyncio
+import hashlib
 import os
-import uuid
+import secrets
+
+import orjson
+from anyio import to_thread
 
 import db
 
@@ -36,17 +42,77 @@ app.add_middleware(
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Uploads are streamed to disk in chunks of this size, so memory use per
+# upload stays constant no matter how big the file is.
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024  # 100 MB
+
 # Serve uploaded files at /files/...
 app.mount("/files", StaticFiles(directory=UPLOAD_DIR), name="files")
 
 # Track active WebSocket connections by username
 active_connections: Dict[str, WebSocket] = {}
 
+# Chat messages are queued here and written in batches by a background
+# task, so a burst of WebSocket traffic costs one commit instead of one
+# fsync per message. Each entry is a row tuple for db.save_messages_bulk.
+_msg_queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+_writer_task: asyncio.Task | None = None
+
+# How long to wait after the first queued message before committing, so
+# messages arriving close together share a transaction.
+BATCH_WINDOW_SECONDS = 0.01
+BATCH_MAX_MESSAGES = 500
+
+
+async def _message_writer() -> None:
+    """
+    Drain the message queue forever, committing each burst in one
+    transaction.
+    """
+    while True:
+        batch = [await _msg_queue.get()]
+        await asyncio.sleep(BATCH_WINDOW_SECONDS)
+        while not _msg_queue.empty() and len(batch) < BATCH_MAX_MESSAGES:
+            batch.append(_msg_queue.get_nowait())
+        try:
+            await run_in_threadpool(db.save_messages_bulk, batch)
+        except Exception as e:
+            print(f"[WS] failed to store {len(batch)} message(s): {e}")
+
 
 @app.on_event("startup")
-def on_startup() -> None:
+async def on_startup() -> None:
+    # All sync DB helpers (and the sync endpoints themselves) run in the
+    # default threadpool; widen it from anyio's default 40 tokens so many
+    # concurrent sockets and requests are not serialized behind it.
+    to_thread.current_default_thread_limiter().total_tokens = 64
+
     # Ensure database and tables exist
-    db.init_db()
+    await run_in_threadpool(db.init_db)
+
+    global _writer_task
+    _writer_task = asyncio.create_task(_message_writer())
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    # Stop the batch writer and flush anything still queued
+    if _writer_task:
+        _writer_task.cancel()
+        try:
+            await _writer_task
+        except asyncio.CancelledError:
+            pass
+
+    pending = []
+    while not _msg_queue.empty():
+        pending.append(_msg_queue.get_nowait())
+    if pending:
+        await run_in_threadpool(db.save_messages_bulk, pending)
+
+    # Let SQLite refresh its planner statistics before we exit
+    await run_in_threadpool(db.optimize)
 
 
 # ---------- Pydantic models ----------
@@ -103,6 +169,7 @@ class FriendSummaryResponse(BaseModel):
 
 
 class MessageItem(BaseModel):
+    id: int
     from_username: str
     to_username: str
     kind: str
@@ -147,13 +214,28 @@ def login(data: LoginRequest):
     if not user:
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
-    if db.hash_password(data.password) != user["password_hash"]:
+    if not db.verify_password(user["password_hash"], data.password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
+    # Transparently upgrade legacy SHA-256 hashes now that we know the
+    # plaintext checks out
+    if not user["password_hash"].startswith("scrypt$"):
+        db.update_password_hash(user["id"], data.password)
+
     token = db.create_session(user["id"])
     return AuthResponse(token=token, username=user["username"])
 
 
+@app.post("/logout")
+def logout(token: str):
+    """
+    Invalidate a session token.
+    """
+    get_current_user(token)  # 401 on unknown token
+    db.delete_session(token)
+    return {"ok": True}
+
+
 @app.get("/me", response_model=MeResponse)
 def me(token: str):
     """
@@ -171,7 +253,7 @@ def me(token: str):
 def send_friend_request(token: str, body: FriendRequestBody):
     me = get_current_user(token)
     try:
-        req = db.create_friend_request(me.id, body.to_username.strip())
+        req = db.create_friend_request(me.id, me.username, body.to_username.strip())
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     return req
@@ -205,7 +287,7 @@ def list_friends(token: str):
 # This is used when a chat is opened so the UI can show messages from SQLite
 # instead of starting from a blank screen after every refresh.
 @app.get("/history", response_model=List[MessageItem])
-def get_history(token: str, friend_username: str, limit: int = 100):
+def get_history(token: str, friend_username: str, limit: int = 100, before_id: int | None = None):
     me = get_current_user(token)
     friend = db.get_user_by_username(friend_username.strip())
     if not friend:
@@ -214,9 +296,12 @@ def get_history(token: str, friend_username: str, limit: int = 100):
     if not db.are_friends(me.id, friend["id"]):
         raise HTTPException(status_code=400, detail="You are not friends with this user")
 
-    rows = db.get_conversation(me.id, friend["id"], limit=limit)
+    # before_id is a keyset cursor: pass the smallest message id already
+    # shown to load the page of older messages before it.
+    rows = db.get_conversation(me.id, friend["id"], limit=limit, before_id=before_id)
     return [
         MessageItem(
+            id=row["id"],
             from_username=row["from_username"],
             to_username=row["to_username"],
             kind=row["kind"],
@@ -253,33 +338,65 @@ async def upload_file(token: str, to_username: str, file: UploadFile = File(...)
       - the sender (if online)
       - and stores it in DB as a 'file' message
     """
-    me = get_current_user(token)
+    # DB helpers are sync sqlite3, so run them in the threadpool to keep
+    # the event loop free for other requests and sockets.
+    me = await run_in_threadpool(get_current_user, token)
 
-    target = db.get_user_by_username(to_username.strip())
+    target = await run_in_threadpool(db.get_user_by_username, to_username.strip())
     if not target:
         raise HTTPException(status_code=400, detail="Target user does not exist")
 
-    if not db.are_friends(me.id, target["id"]):
+    if not await run_in_threadpool(db.are_friends, me.id, target["id"]):
         raise HTTPException(status_code=400, detail="You are not friends with this user")
 
     original_name = os.path.basename(file.filename or "file.bin")
     if len(original_name) > 100:
         original_name = original_name[-100:]
 
-    unique_name = f"{uuid.uuid4().hex}_{original_name}"
-    dest_path = UPLOAD_DIR / unique_name
-
-    contents = await file.read()
+    # Stream to a temp file chunk by chunk instead of reading the whole
+    # upload into memory, hashing the content along the way; disk writes
+    # go through the threadpool so other coroutines keep running during
+    # a large upload.
+    tmp_path = UPLOAD_DIR / f".tmp-{secrets.token_hex(8)}"
+    hasher = hashlib.blake2b(digest_size=16)
+    total = 0
     try:
-        with open(dest_path, "wb") as f:
-            f.write(contents)
+        with open(tmp_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                hasher.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+    except HTTPException:
+        tmp_path.unlink(missing_ok=True)
+        raise
     except OSError as e:
+        tmp_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
 
+    # Content-addressed name: identical files (with the same name) map
+    # to the same path, so a re-upload is stored and served once
+    unique_name = f"{hasher.hexdigest()}_{original_name}"
+    dest_path = UPLOAD_DIR / unique_name
+    if dest_path.exists():
+        tmp_path.unlink(missing_ok=True)
+    else:
+        os.replace(tmp_path, dest_path)
+
     url_path = f"/files/{unique_name}"
 
     # Save in DB
-    db.save_message(me.id, target["id"], kind="file", text=original_name, url=url_path)
+    await run_in_threadpool(
+        db.save_message,
+        me.id,
+        target["id"],
+        "file",
+        original_name,
+        url_path,
+        me.username,
+        target["username"],
+    )
 
     ws_payload = {
         "type": "file",
@@ -288,15 +405,17 @@ async def upload_file(token: str, to_username: str, file: UploadFile = File(...)
         "url": url_path,
     }
 
-    # Notify recipient if online
-    target_ws = active_connections.get(target["username"])
-    if target_ws:
-        await target_ws.send_json(ws_payload)
-
-    # Also echo to sender if they have WS open
-    sender_ws = active_connections.get(me.username)
-    if sender_ws:
-        await sender_ws.send_json(ws_payload)
+    # Notify recipient and echo to sender, concurrently, if online
+    recipients = [
+        ws
+        for ws in (
+            active_connections.get(target["username"]),
+            active_connections.get(me.username),
+        )
+        if ws
+    ]
+    if recipients:
+        await _broadcast(ws_payload, *recipients)
 
     return ws_payload
 
@@ -304,11 +423,38 @@ async def upload_file(token: str, to_username: str, file: UploadFile = File(...)
 # ---------- WebSocket chat: 1-to-1 between friends ----------
 
 
+def _encode(payload: dict) -> str:
+    """
+    Serialize a payload with orjson. The browser client expects text
+    frames, so the bytes are decoded once here.
+    """
+    return orjson.dumps(payload).decode()
+
+
 async def _send_system(ws: WebSocket, message: str) -> None:
     """
     Small helper to send a system/info message over WebSocket.
     """
-    await ws.send_json({"type": "system", "message": message})
+    await ws.send_text(_encode({"type": "system", "message": message}))
+
+
+async def _broadcast(payload: dict, *sockets: WebSocket) -> None:
+    """
+    Send one payload to several sockets concurrently.
+
+    The payload is serialized once and the sends run via asyncio.gather,
+    so one slow or dead peer does not delay the others. Sockets that
+    fail are dropped from active_connections.
+    """
+    data = _encode(payload)
+    results = await asyncio.gather(
+        *(ws.send_text(data) for ws in sockets), return_exceptions=True
+    )
+    for ws, result in zip(sockets, results):
+        if isinstance(result, Exception):
+            for name, conn in list(active_connections.items()):
+                if conn is ws:
+                    active_connections.pop(name, None)
 
 
 @app.websocket("/ws/chat")
@@ -337,7 +483,7 @@ async def chat_ws(websocket: WebSocket):
         return
 
     try:
-        me = get_current_user(token)
+        me = await run_in_threadpool(get_current_user, token)
     except HTTPException:
         await websocket.close(code=4401)
         return
@@ -350,7 +496,7 @@ async def chat_ws(websocket: WebSocket):
 
     try:
         while True:
-            data = await websocket.receive_json()
+            data = orjson.loads(await websocket.receive_text())
 
             msg_type = data.get("type")
             if msg_type != "chat":
@@ -364,12 +510,14 @@ async def chat_ws(websocket: WebSocket):
                 await _send_system(websocket, "Both 'to' and 'text' fields are required.")
                 continue
 
-            target = db.get_user_by_username(to_username)
-            if not target:
+            # Usernames never change, so after the first message to a user
+            # this resolves from the in-process map without touching SQLite
+            target_id = await run_in_threadpool(db.resolve_username, to_username)
+            if target_id is None:
                 await _send_system(websocket, f"User '{to_username}' does not exist.")
                 continue
 
-            if not db.are_friends(me.id, target["id"]):
+            if not await run_in_threadpool(db.are_friends, me.id, target_id):
                 await _send_system(websocket, f"You are not friends with '{to_username}'.")
                 continue
 
@@ -377,19 +525,19 @@ async def chat_ws(websocket: WebSocket):
             if not target_ws:
                 await _send_system(websocket, f"User '{to_username}' is currently offline.")
                 # Still store the message even if offline
-                db.save_message(me.id, target["id"], kind="text", text=text, url=None)
+                _msg_queue.put_nowait((me.id, target_id, "text", text, None))
                 continue
 
-            # Store message in DB
-            db.save_message(me.id, target["id"], kind="text", text=text, url=None)
+            # Queue for the batch writer; the payload is built from what
+            # we already know, so there is no need to wait for the INSERT.
+            _msg_queue.put_nowait((me.id, target_id, "text", text, None))
 
             msg_payload = {
                 "type": "chat",
                 "from": username,
                 "text": text,
             }
-            await target_ws.send_json(msg_payload)
-            await websocket.send_json(msg_payload)
+            await _broadcast(msg_payload, target_ws, websocket)
 
     except WebSocketDisconnect:
         print(f"[WS] {username} disconnected")